@@ -1,12 +1,22 @@
 import json
 import time
+import asyncio
 import logging
+import aiohttp
+import orjson
 import requests
 import os
+import sqlite3
+import random
+import re
+from collections import Counter
 from datetime import datetime
 import firebase_admin
 from firebase_admin import credentials, firestore
 
+# Everything in a Steam price string except digits and separators
+_PRICE_RE = re.compile(r'[^\d.,]')
+
 # Configure logging
 def setup_logging(log_file):
     logging.basicConfig(
@@ -28,40 +38,177 @@ def load_config():
         exit(1)
 
 
-def load_price_cache(path):
+def _open_price_cache(path):
+    conn = sqlite3.connect(path)
     try:
-        if os.path.exists(path):
-            with open(path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-    except Exception as e:
-        logging.warning(f"Could not load price cache {path}: {e}")
-    return {}
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS prices ("
+            "name TEXT PRIMARY KEY, price REAL, ts REAL, appid TEXT, currency TEXT)"
+        )
+    except Exception:
+        conn.close()
+        raise
+    return conn
 
 
-def save_price_cache(path, cache):
+def import_json_price_cache(price_cache, json_path):
+    """
+    Copies entries from a pre-SQLite JSON price cache into the prices table.
+    """
+    with open(json_path, 'rb') as f:
+        entries = orjson.loads(f.read())
+    for key, entry in entries.items():
+        try:
+            set_cache_entry(price_cache, key, {
+                'price': float(entry['price']),
+                'timestamp': float(entry['timestamp']),
+                'appid': str(entry['appid']),
+                'currency': str(entry['currency'])
+            })
+        except Exception:
+            pass
+    price_cache.commit()
+
+
+def load_price_cache(path, max_entries=50000, max_age_seconds=3600):
+    """
+    Opens the SQLite price cache, creating the prices table if needed.
+    If path is an old JSON cache, a sibling .db file is used instead and
+    seeded from it. Returns None if the cache can't be opened (prices are
+    then always fetched).
+    """
+    try:
+        try:
+            conn = _open_price_cache(path)
+        except sqlite3.OperationalError:
+            # Locked/unreadable file, not a format problem
+            raise
+        except sqlite3.DatabaseError:
+            db_path = os.path.splitext(path)[0] + '.db'
+            if db_path == path:
+                raise
+            logging.error(
+                f"Price cache {path} is not a SQLite database (older JSON cache?). "
+                f"Using {db_path} instead; set price_cache_file to {db_path} in config.json."
+            )
+            is_new = not os.path.exists(db_path)
+            conn = _open_price_cache(db_path)
+            if is_new:
+                try:
+                    import_json_price_cache(conn, path)
+                except Exception as e:
+                    logging.error(f"Could not import old price cache {path}: {e}")
+                    conn.rollback()
+    except Exception as e:
+        logging.error(f"Could not load price cache {path}: {e}")
+        return None
+
+    # Pruning is housekeeping; a failure here shouldn't disable the cache
     try:
-        with open(path, 'w', encoding='utf-8') as f:
-            json.dump(cache, f)
+        prune_price_cache(conn, max_entries, max_age_seconds)
     except Exception as e:
-        logging.error(f"Failed to save price cache {path}: {e}")
+        logging.warning(f"Could not prune price cache {path}: {e}")
+        conn.rollback()
+    return conn
+
+
+def prune_price_cache(price_cache, max_entries, max_age_seconds):
+    """
+    Drops entries that have been stale for a day, then caps the table at
+    max_entries by evicting the least recently fetched rows.
+    """
+    price_cache.execute("DELETE FROM prices WHERE ts < ?", (time.time() - max_age_seconds * 24,))
+    price_cache.execute(
+        "DELETE FROM prices WHERE name NOT IN (SELECT name FROM prices ORDER BY ts DESC LIMIT ?)",
+        (max_entries,)
+    )
+    price_cache.commit()
+
+
+def get_cache_entry(price_cache, key):
+    row = price_cache.execute(
+        "SELECT price, ts, appid, currency FROM prices WHERE name=?", (key,)
+    ).fetchone()
+    if row is None:
+        return None
+    price, ts, appid, currency = row
+    return {'price': price, 'timestamp': ts, 'appid': appid, 'currency': currency}
 
 
-def is_cache_valid(entry, max_age_seconds=3600):
+def set_cache_entry(price_cache, key, entry):
+    price_cache.execute(
+        "INSERT OR REPLACE INTO prices (name, price, ts, appid, currency) VALUES (?, ?, ?, ?, ?)",
+        (key, entry['price'], entry['timestamp'], entry['appid'], entry['currency'])
+    )
+
+
+def is_cache_valid(entry, max_age_seconds=3600, zero_max_age=86400, now=None):
+    # Items priced at 0.0 rarely gain value, so they are kept much longer
+    if now is None:
+        now = time.time()
     try:
         ts = float(entry.get('timestamp', 0))
-        return (time.time() - ts) < max_age_seconds
+        max_age = zero_max_age if float(entry.get('price', 0)) == 0.0 else max_age_seconds
+        return (now - ts) < max_age
     except Exception:
         return False
 
-def saveToFirestore(data, steam_id, firebase_service_account):
-    cred = credentials.Certificate(firebase_service_account)
-    firebase_admin.initialize_app(cred)
-    db = firestore.client()
+def _retry_after(resp, default):
+    """
+    Returns the Retry-After header in seconds, clamped to 120, or default if
+    it is missing or not a positive number of seconds (e.g. an HTTP date).
+    """
+    value = resp.headers.get('Retry-After')
+    if value is None:
+        return default
+    try:
+        seconds = int(value)
+    except ValueError:
+        return default
+    if seconds <= 0:
+        return default
+    return min(120, seconds)
+
+def backoff_delay(attempt, resp=None):
+    """
+    Returns how long to wait before retrying a rate-limited request.
+    Honors Retry-After when present, otherwise exponential backoff with jitter.
+    """
+    delay = min(60, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5)
+    if resp is None:
+        return delay
+    return _retry_after(resp, delay)
+
+def backoff_sleep(attempt, resp=None):
+    time.sleep(backoff_delay(attempt, resp))
+
+def init_firestore(firebase_service_account):
+    """
+    Initializes the default Firebase app once and returns a Firestore client.
+    """
+    if not firebase_admin._apps:
+        cred = credentials.Certificate(firebase_service_account)
+        firebase_admin.initialize_app(cred)
+    return firestore.client()
+
+def saveToFirestore(db, data, steam_id):
+    saveAllToFirestore(db, [data], steam_id)
+
+def saveAllToFirestore(db, values, steam_id):
+    """
+    Writes each value as a new entry, batching them into as few commits as possible.
+    """
     entries_ref = db.collection('inventory_values').document(steam_id).collection('entries')
-    entries_ref.add({
-        'value': data,
-        'timestamp': firestore.SERVER_TIMESTAMP
-    })
+    # Firestore caps a batch at 500 writes
+    for start in range(0, len(values), 500):
+        batch = db.batch()
+        for value in values[start:start + 500]:
+            batch.set(entries_ref.document(), {
+                'value': value,
+                'timestamp': firestore.SERVER_TIMESTAMP
+            })
+        batch.commit()
 
 def get_inventory(steam_id, app_id, context_id, session):
     """
@@ -77,29 +224,33 @@ def get_inventory(steam_id, app_id, context_id, session):
     full_assets = []
     full_descriptions = []
     more_items = True
-    start_assetid = None
+    attempt = 0
+    # Pause between pages; grows after a 429 and decays back to zero on success
+    delay = 0.0
     
     logging.info(f"Fetching inventory for {steam_id} (App: {app_id})...")
 
     while more_items:
-        req_params = params.copy()
-        if start_assetid:
-            req_params['start_assetid'] = start_assetid
-        
         try:
-            logging.info(f"Requesting page... (start_assetid={start_assetid})")
-            response = session.get(url, params=req_params)
+            logging.info(f"Requesting page... (start_assetid={params.get('start_assetid')})")
+            response = session.get(url, params=params)
             
             if response.status_code == 429:
-                logging.error("Rate limited fetching inventory. Too many requests. Waiting 60s...")
-                time.sleep(60)
+                if attempt >= 6:
+                    logging.error("Rate limited fetching inventory. Giving up after 6 attempts.")
+                    return None
+                logging.warning(f"Rate limited fetching inventory. Retrying (attempt {attempt + 1}/6)...")
+                delay = max(delay * 2, 1.0)
+                backoff_sleep(attempt, response)
+                attempt += 1
                 continue
+            attempt = 0
             
             if response.status_code != 200:
                 logging.error(f"Failed to fetch inventory. Status: {response.status_code}. Response: {response.text}")
                 return None
 
-            data = response.json()
+            data = orjson.loads(response.content)
             if not data.get('success'):
                 logging.error("Steam API reported failure in fetching inventory.")
                 return None
@@ -110,9 +261,12 @@ def get_inventory(steam_id, app_id, context_id, session):
             full_assets.extend(assets)
             full_descriptions.extend(descriptions)
             
+            delay = delay * 0.5 if delay >= 0.1 else 0.0
             if data.get('more_items'):
-                start_assetid = data.get('last_assetid')
-                time.sleep(2) # Be nice to the API
+                # Continue from the last asset on the next request
+                params['start_assetid'] = data.get('last_assetid')
+                if delay > 0:
+                    time.sleep(delay) # Be nice to the API while it is pushing back
             else:
                 more_items = False
                 
@@ -126,7 +280,21 @@ def get_inventory(steam_id, app_id, context_id, session):
         'success': True
     }
 
-def get_item_price(market_hash_name, app_id, currency, session, price_cache=None, cache_path=None):
+def get_cached_price(market_hash_name, app_id, currency, price_cache, now=None):
+    """
+    Returns the cached price for an item, or None if it must be fetched.
+    """
+    if price_cache is None:
+        return None
+    entry = get_cache_entry(price_cache, market_hash_name)
+    if entry and entry.get('appid') == str(app_id) and entry.get('currency') == str(currency) and is_cache_valid(entry, 3600, now=now):
+        try:
+            return float(entry.get('price', 0.0))
+        except Exception:
+            pass
+    return None
+
+async def get_item_price(session, sem, market_hash_name, app_id, currency, price_cache=None):
     """
     Fetches price for a single item.
     """
@@ -136,27 +304,29 @@ def get_item_price(market_hash_name, app_id, currency, session, price_cache=None
         "currency": currency,
         "market_hash_name": market_hash_name
     }
-    
-    # Check cache first (1 hour)
-    try:
-        key = market_hash_name
-        entry = None
-        if price_cache is not None:
-            entry = price_cache.get(key)
-        if entry and entry.get('appid') == str(app_id) and entry.get('currency') == str(currency) and is_cache_valid(entry, 3600):
-            try:
-                return float(entry.get('price', 0.0))
-            except Exception:
-                pass
-
-        response = session.get(url, params=params)
-        
-        if response.status_code == 429:
-            logging.warning(f"Rate limited on price check for {market_hash_name}. Waiting longer...")
-            return "429"
+    key = market_hash_name
+
+    async with sem:
+        try:
+            for attempt in range(5):
+                async with session.get(url, params=params) as response:
+                    status = response.status
+                    if status == 200:
+                        data = await response.json(content_type=None, loads=orjson.loads)
+                    elif status == 429:
+                        delay = backoff_delay(attempt, response)
+                if status != 429:
+                    break
+                if attempt == 4:
+                    logging.warning(f"Giving up on price check for {market_hash_name} after 5 rate-limited attempts.")
+                    return 0.0
+                logging.warning(f"Rate limited on price check for {market_hash_name}. Retrying in {delay:.1f}s...")
+                await asyncio.sleep(delay)
+
+            if status != 200:
+                logging.warning(f"Failed to get price for {market_hash_name}. Status: {status}")
+                return 0.0
 
-        if response.status_code == 200:
-            data = response.json()
             if data.get('success'):
                 # Prefer lowest_price, fallback to median_price
                 price_str = data.get('lowest_price', data.get('median_price'))
@@ -166,41 +336,74 @@ def get_item_price(market_hash_name, app_id, currency, session, price_cache=None
                     
                     # Simple hacky parser for common steam formats ($1.00, 1,00€, £1.00)
                     # Remove currency symbols and non-numeric chars except . and ,
-                    clean_str = ''.join([c for c in price_str if c.isdigit() or c in ['.', ',']])
+                    clean_str = _PRICE_RE.sub('', price_str)
                     # Replace , with . if it looks like a decimal separator (European)
                     if ',' in clean_str and '.' not in clean_str:
                         clean_str = clean_str.replace(',', '.')
-                    # If both exist, standard is usually 1,234.56 or 1.234,56
+                    elif ',' in clean_str:
+                        # If both exist, standard is usually 1,234.56 or 1.234,56:
+                        # the last separator is the decimal one, the other groups thousands
+                        if clean_str.rfind(',') > clean_str.rfind('.'):
+                            clean_str = clean_str.replace('.', '').replace(',', '.')
+                        else:
+                            clean_str = clean_str.replace(',', '')
                     try:
                         price_val = float(clean_str)
                         # update cache
-                        if price_cache is not None and cache_path:
-                            price_cache[key] = {
+                        if price_cache is not None:
+                            set_cache_entry(price_cache, key, {
                                 'price': price_val,
                                 'timestamp': time.time(),
                                 'appid': str(app_id),
                                 'currency': str(currency)
-                            }
-                            save_price_cache(cache_path, price_cache)
+                            })
                         return price_val
                     except ValueError:
+                        # Not cached, so a format change on Steam's side is picked up next run
                         logging.warning(f"Could not parse price string: {price_str}")
-                        if price_cache is not None and cache_path:
-                            price_cache[key] = {
-                                'price': 0.0,
-                                'timestamp': time.time(),
-                                'appid': str(app_id),
-                                'currency': str(currency)
-                            }
-                            save_price_cache(cache_path, price_cache)
                         return 0.0
+                # No listings: cache as worthless so is_cache_valid applies the longer zero-price TTL
+                if price_cache is not None:
+                    set_cache_entry(price_cache, key, {
+                        'price': 0.0,
+                        'timestamp': time.time(),
+                        'appid': str(app_id),
+                        'currency': str(currency)
+                    })
             return 0.0
-        else:
-            logging.warning(f"Failed to get price for {market_hash_name}. Status: {response.status_code}")
+        except Exception as e:
+            logging.error(f"Error getting price for {market_hash_name}: {e}")
             return 0.0
-    except Exception as e:
-        logging.error(f"Error getting price for {market_hash_name}: {e}")
-        return 0.0
+
+async def get_prices(item_counts, app_id, currency, headers, max_concurrency, price_cache=None):
+    """
+    Fetches prices for all items concurrently, bounded by max_concurrency.
+    Cached items are resolved without issuing a request.
+    """
+    prices = {}
+    pending = []
+    # One clock reading so every cache decision in this run agrees
+    now = time.time()
+    for name in item_counts:
+        cached = get_cached_price(name, app_id, currency, price_cache, now=now)
+        if cached is not None:
+            prices[name] = cached
+        else:
+            pending.append(name)
+
+    sem = asyncio.Semaphore(max_concurrency)
+    connector = aiohttp.TCPConnector(limit=max_concurrency)
+    async with aiohttp.ClientSession(headers=headers, connector=connector) as session:
+        tasks = [get_item_price(session, sem, name, app_id, currency, price_cache=price_cache) for name in pending]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    for name, result in zip(pending, results):
+        if isinstance(result, Exception):
+            logging.error(f"Error getting price for {name}: {result}")
+            result = 0.0
+        prices[name] = result
+
+    return prices
 
 def main():
     config = load_config()
@@ -210,23 +413,30 @@ def main():
     app_id = config['app_id']
     context_id = config['context_id']
     currency = config['currency']
-    sleep_interval = config.get('sleep_interval', 3)
+    max_concurrency = max(1, int(config.get('max_concurrency', 8)))
     firebase_service_account = config.get('firebase_service_account')
 
     if steam_id == "YOUR_STEAM_ID_64":
         logging.error("Please configure your Steam ID in config.json")
         return
 
-    session = requests.Session()
     # Spoof User-Agent and Referer to avoid strict bot blocking and 400 errors
-    session.headers.update({
+    headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
         'Referer': f'https://steamcommunity.com/profiles/{steam_id}/inventory'
+    }
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=0)
+    session.mount('https://', adapter)
+    session.headers.update(headers)
+    session.headers.update({
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive'
     })
 
-    # Load price cache (JSON file) used for 1-hour caching of market prices
-    cache_path = config.get('price_cache_file', 'price_cache.json')
-    price_cache = load_price_cache(cache_path)
+    # Load price cache (SQLite database) used for 1-hour caching of market prices
+    cache_path = config.get('price_cache_file', 'price_cache.db')
+    price_cache = load_price_cache(cache_path, max_entries=config.get('price_cache_max_entries', 50000))
 
     inventory_data = get_inventory(steam_id, app_id, context_id, session)
     
@@ -239,71 +449,43 @@ def main():
     assets = inventory_data.get('assets', [])
     descriptions = inventory_data.get('descriptions', [])
     
-    # Map classid_instanceid to market_hash_name
-    # descriptions have 'classid' and optionally 'instanceid'
-    # We need to link assets to descriptions to get the name
-    
-    desc_map = {}
-    for desc in descriptions:
-        # Key can be just classid usually, but instanceid helps for specific skins sometimes
-        key = (desc['classid'], desc['instanceid'])
-        # Also store by just classid as fallback if instanceid is '0' in asset but specific in description?
-        # Usually asset.classid matches description.classid.
-        desc_map[desc['classid']] = desc
-
-    # Aggregate counts by market_hash_name
-    item_counts = {}
-    
-    for asset in assets:
-        classid = asset['classid']
-        # instanceid = asset['instanceid'] # often not needed for name mapping if market_hash_name is consistent
-        
-        desc = desc_map.get(classid)
-        if desc and desc.get('marketable', 0) == 1: # Only price marketable items
-            name = desc['market_hash_name']
-            item_counts[name] = item_counts.get(name, 0) + 1
-        else:
-            # Non-marketable item, skip or log
-            pass
+    # Map (classid, instanceid) to the description, which holds market_hash_name
+    desc_map = {(d['classid'], d.get('instanceid', '0')): d for d in descriptions}
+
+    # Aggregate counts by market_hash_name, only pricing marketable items
+    marketable = (desc_map.get((a['classid'], a.get('instanceid', '0'))) for a in assets)
+    item_counts = Counter(d['market_hash_name'] for d in marketable if d and d.get('marketable', 0) == 1)
 
     logging.info(f"Found {len(item_counts)} unique marketable items.")
     
-    total_value = 0.0
-    # session created above
+    # Get Prices (use cache, fetch the rest concurrently)
+    prices = asyncio.run(get_prices(item_counts, app_id, currency, headers, max_concurrency, price_cache=price_cache))
 
+    total_value = 0.0
     current_index = 0
     total_items = len(item_counts)
 
     for name, count in item_counts.items():
         current_index += 1
-        
-        # Get Price (use cache)
-        price = get_item_price(name, app_id, currency, session, price_cache=price_cache, cache_path=cache_path)
-        
-        if price == "429":
-            logging.warning("Hit rate limit. Sleeping for 60 seconds...")
-            time.sleep(60)
-            price = get_item_price(name, app_id, currency, session, price_cache=price_cache, cache_path=cache_path) # Retry once
-            if price == "429":
-                price = 0.0 # Give up on this item
+        price = prices.get(name, 0.0)
         
         item_total = price * count
         total_value += item_total
         
         logging.info(f"[{current_index}/{total_items}] {name}: {count} x {price} = {item_total:.2f}")
-        
-        # Sleep to avoid rate limits
-        time.sleep(sleep_interval)
     
     # Persist cache after run
-    try:
-        save_price_cache(cache_path, price_cache)
-    except Exception:
-        pass
+    if price_cache is not None:
+        try:
+            price_cache.commit()
+            price_cache.close()
+        except Exception as e:
+            logging.error(f"Failed to save price cache {cache_path}: {e}")
 
     # Save to Firestore
     try:
-        saveToFirestore(total_value, steam_id, firebase_service_account)
+        db = init_firestore(firebase_service_account)
+        saveToFirestore(db, total_value, steam_id)
     except Exception as e:
         logging.error(f"Error saving to Firestore: {e}")
     